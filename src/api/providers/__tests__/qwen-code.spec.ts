@@ -0,0 +1,519 @@
+// npx vitest run api/providers/__tests__/qwen-code.spec.ts
+
+const { mockReadFile, mockWriteFile, mockRename, mockUnlink, mockStat, mockLock } = vi.hoisted(() => ({
+	mockReadFile: vi.fn(),
+	mockWriteFile: vi.fn(),
+	mockRename: vi.fn(),
+	mockUnlink: vi.fn(),
+	mockStat: vi.fn(),
+	mockLock: vi.fn(),
+}))
+
+vi.mock("node:fs", () => ({
+	promises: {
+		readFile: mockReadFile,
+		writeFile: mockWriteFile,
+		rename: mockRename,
+		unlink: mockUnlink,
+		stat: mockStat,
+	},
+}))
+
+vi.mock("proper-lockfile", () => ({
+	lock: mockLock,
+}))
+
+const mockCreate = vi.fn()
+
+vi.mock("openai", () => ({
+	default: vi.fn(() => ({
+		chat: {
+			completions: {
+				create: mockCreate,
+			},
+		},
+	})),
+}))
+
+import OpenAI from "openai"
+
+import { QwenCodeHandler } from "../qwen-code"
+
+let pathCounter = 0
+
+function uniqueOauthPath(): string {
+	// The credential cache is module-level, so give each test its own file.
+	return `/tmp/qwen-code-spec-${++pathCounter}.json`
+}
+
+function makeCredentials(overrides: Record<string, unknown> = {}) {
+	return {
+		access_token: "access-token",
+		refresh_token: "refresh-token",
+		token_type: "Bearer",
+		expiry_date: Date.now() + 60 * 60 * 1000,
+		resource_url: "portal.qwen.ai",
+		...overrides,
+	}
+}
+
+function tokenResponse(expiresIn = 3600) {
+	return new Response(
+		JSON.stringify({ access_token: "new-access-token", token_type: "Bearer", expires_in: expiresIn }),
+		{ status: 200 },
+	)
+}
+
+describe("QwenCodeHandler", () => {
+	beforeEach(() => {
+		vi.clearAllMocks()
+		mockStat.mockResolvedValue({ mtimeMs: 1 })
+		mockWriteFile.mockResolvedValue(undefined)
+		mockRename.mockResolvedValue(undefined)
+		mockUnlink.mockResolvedValue(undefined)
+		mockLock.mockResolvedValue(async () => {})
+		mockCreate.mockResolvedValue({ choices: [{ message: { content: "Test response" } }] })
+		global.fetch = vi.fn()
+	})
+
+	afterEach(() => {
+		vi.restoreAllMocks()
+	})
+
+	describe("credential loading", () => {
+		it("should reuse parsed credentials across handlers while the file is unchanged", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials()))
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("first")
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("second")
+
+			expect(mockStat).toHaveBeenCalledTimes(2)
+			expect(mockReadFile).toHaveBeenCalledTimes(1)
+		})
+
+		it("should re-read credentials when the file mtime changes", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials()))
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("first")
+			mockStat.mockResolvedValue({ mtimeMs: 2 })
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("second")
+
+			expect(mockReadFile).toHaveBeenCalledTimes(2)
+		})
+
+		it("should share a single credential load between concurrent requests", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials()))
+			const handler = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() })
+
+			const results = await Promise.all([
+				handler.completePrompt("first"),
+				handler.completePrompt("second"),
+				handler.completePrompt("third"),
+			])
+
+			expect(results).toEqual(["Test response", "Test response", "Test response"])
+			expect(mockStat).toHaveBeenCalledTimes(1)
+			expect(mockReadFile).toHaveBeenCalledTimes(1)
+			expect(mockCreate).toHaveBeenCalledTimes(3)
+		})
+
+		it("should throw when the credentials file is missing", async () => {
+			mockStat.mockRejectedValue(new Error("ENOENT"))
+			vi.spyOn(console, "error").mockImplementation(() => {})
+
+			await expect(
+				new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test"),
+			).rejects.toThrow("Failed to load Qwen OAuth credentials")
+		})
+	})
+
+	describe("base URL", () => {
+		it.each([
+			["portal.qwen.ai", "https://portal.qwen.ai/v1"],
+			["https://portal.qwen.ai", "https://portal.qwen.ai/v1"],
+			["http://localhost:8080/v1", "http://localhost:8080/v1"],
+			[undefined, "https://dashscope.aliyuncs.com/compatible-mode/v1"],
+		])("should normalize resource_url %s to %s", async (resourceUrl, expected) => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ resource_url: resourceUrl })))
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			const client = vi.mocked(OpenAI).mock.results.at(-1)!.value
+			expect(client.baseURL).toBe(expected)
+		})
+	})
+
+	describe("token refresh", () => {
+		it("should refresh expired credentials before calling the API", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			const result = await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			expect(result).toBe("Test response")
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+			expect(mockWriteFile).toHaveBeenCalledTimes(1)
+			expect(JSON.parse(mockWriteFile.mock.calls[0][1]).access_token).toBe("new-access-token")
+		})
+
+		it("should save refreshed credentials via an owner-only temp file renamed over the target", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+
+			const [tempPath, contents, options] = mockWriteFile.mock.calls[0]
+			expect(tempPath).toMatch(/\/\.qwen-code-spec-\d+\.json\.new_\d+_\w+\.tmp$/)
+			expect(JSON.parse(contents).access_token).toBe("new-access-token")
+			expect(options).toEqual({ mode: 0o600 })
+			expect(mockLock).toHaveBeenCalledWith(qwenCodeOauthPath, expect.objectContaining({ realpath: false }))
+			expect(mockRename).toHaveBeenCalledTimes(1)
+			expect(mockRename).toHaveBeenCalledWith(tempPath, qwenCodeOauthPath)
+		})
+
+		it("should keep the credentials file in place for the whole save", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			// A tiny in-memory file system that checks the target exists after every step
+			const files = new Set([qwenCodeOauthPath])
+			const assertTargetExists = () => expect(files.has(qwenCodeOauthPath)).toBe(true)
+			mockWriteFile.mockImplementation(async (filePath: string) => {
+				files.add(filePath)
+				assertTargetExists()
+			})
+			mockRename.mockImplementation(async (from: string, to: string) => {
+				files.delete(from)
+				files.add(to)
+				assertTargetExists()
+			})
+			mockUnlink.mockImplementation(async (filePath: string) => {
+				files.delete(filePath)
+				assertTargetExists()
+			})
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+
+			expect(mockRename).toHaveBeenCalled()
+			expect([...files]).toEqual([qwenCodeOauthPath])
+		})
+
+		it("should remove the temp file when the rename fails", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			const consoleError = vi.spyOn(console, "error").mockImplementation(() => {})
+			mockRename.mockRejectedValue(new Error("EXDEV"))
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			// The refreshed token is still used in memory
+			await expect(new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")).resolves.toBe(
+				"Test response",
+			)
+
+			expect(mockUnlink).toHaveBeenCalledWith(mockWriteFile.mock.calls[0][0])
+			expect(consoleError).toHaveBeenCalledWith("Failed to save refreshed credentials:", expect.any(Error))
+		})
+
+		it("should not re-read credentials it has just saved", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			// The loads before the refresh see the old file; every stat after our own write sees the new mtime
+			mockStat
+				.mockResolvedValueOnce({ mtimeMs: 1 })
+				.mockResolvedValueOnce({ mtimeMs: 1 })
+				.mockResolvedValue({ mtimeMs: 2 })
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("first")
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("second")
+
+			expect(mockReadFile).toHaveBeenCalledTimes(1)
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+
+		it("should not report a successful save as failed when seeding the cache fails", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			const consoleError = vi.spyOn(console, "error").mockImplementation(() => {})
+			mockStat
+				.mockResolvedValueOnce({ mtimeMs: 1 })
+				.mockResolvedValueOnce({ mtimeMs: 1 })
+				.mockRejectedValueOnce(new Error("EBUSY"))
+				.mockResolvedValue({ mtimeMs: 2 })
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+
+			expect(mockWriteFile).toHaveBeenCalledTimes(1)
+			expect(consoleError).not.toHaveBeenCalledWith("Failed to save refreshed credentials:", expect.anything())
+
+			// Nothing was seeded, so the next load reads the file again
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ access_token: "new-access-token" })))
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+			expect(mockReadFile).toHaveBeenCalledTimes(2)
+		})
+
+		it("should re-read the credentials file after a failed refresh", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			vi.spyOn(console, "error").mockImplementation(() => {})
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(
+				new Response(JSON.stringify({ error: "invalid_grant" }), { status: 400 }),
+			)
+
+			await expect(new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")).rejects.toThrow(
+				"Token refresh failed",
+			)
+
+			// The file was rewritten by someone else without the mtime changing from our point of view
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ access_token: "other-window-token" })))
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+			const client = vi.mocked(OpenAI).mock.results.at(-1)!.value
+			expect(client.apiKey).toBe("other-window-token")
+		})
+
+		it("should refresh credentials that expire within the safety buffer", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() + 2 * 60 * 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+	})
+
+	describe("slow token endpoint allowance", () => {
+		// Refresh once with a token request that appears to take rttMs, so the
+		// module records that round-trip time for later validity checks
+		async function refreshWithRoundTrip(rttMs: number) {
+			vi.spyOn(performance, "now").mockReturnValueOnce(0).mockReturnValueOnce(rttMs)
+			mockReadFile.mockResolvedValueOnce(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockResolvedValueOnce(tokenResponse())
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("prime")
+			vi.mocked(global.fetch).mockClear()
+		}
+
+		// Valid under the 5 minute buffer alone, but not once a 2.5s allowance is added
+		const justOutsideBuffer = () => makeCredentials({ expiry_date: Date.now() + 5 * 60 * 1000 + 2000 })
+
+		it("should refresh earlier after a token request slower than 1s", async () => {
+			await refreshWithRoundTrip(2500)
+			mockReadFile.mockResolvedValue(JSON.stringify(justOutsideBuffer()))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+
+		it("should not add an allowance after a token request faster than 1s", async () => {
+			await refreshWithRoundTrip(500)
+			mockReadFile.mockResolvedValue(JSON.stringify(justOutsideBuffer()))
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			expect(global.fetch).not.toHaveBeenCalled()
+		})
+	})
+
+	describe("token endpoint retries", () => {
+		beforeEach(() => {
+			vi.useFakeTimers()
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+		})
+
+		afterEach(() => {
+			vi.useRealTimers()
+		})
+
+		it("should retry transient token endpoint failures", async () => {
+			const unavailable = new Response("unavailable", { status: 503 })
+			const cancelBody = vi.spyOn(unavailable.body!, "cancel")
+			vi.mocked(global.fetch).mockResolvedValueOnce(unavailable).mockResolvedValueOnce(tokenResponse())
+
+			const promise = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+			await vi.advanceTimersByTimeAsync(1000)
+
+			await expect(promise).resolves.toBe("Test response")
+			expect(global.fetch).toHaveBeenCalledTimes(2)
+			expect(cancelBody).toHaveBeenCalled()
+		})
+
+		it("should retry network-level fetch failures", async () => {
+			vi.mocked(global.fetch)
+				.mockRejectedValueOnce(new TypeError("fetch failed"))
+				.mockResolvedValueOnce(tokenResponse())
+
+			const promise = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+			await vi.advanceTimersByTimeAsync(1000)
+
+			await expect(promise).resolves.toBe("Test response")
+			expect(global.fetch).toHaveBeenCalledTimes(2)
+		})
+
+		it("should wait for Retry-After before retrying a 429", async () => {
+			vi.mocked(global.fetch)
+				.mockResolvedValueOnce(new Response("slow down", { status: 429, headers: { "Retry-After": "3" } }))
+				.mockResolvedValueOnce(tokenResponse())
+
+			const promise = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			await vi.advanceTimersByTimeAsync(2900)
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+
+			await vi.advanceTimersByTimeAsync(200)
+			await expect(promise).resolves.toBe("Test response")
+			expect(global.fetch).toHaveBeenCalledTimes(2)
+		})
+
+		it("should give up when the network keeps failing", async () => {
+			vi.mocked(global.fetch).mockRejectedValue(new TypeError("fetch failed"))
+
+			const promise = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+			const assertion = expect(promise).rejects.toThrow("fetch failed")
+			await vi.advanceTimersByTimeAsync(5000)
+
+			await assertion
+			expect(global.fetch).toHaveBeenCalledTimes(4)
+		})
+	})
+
+	describe("background refresh", () => {
+		beforeEach(() => {
+			vi.useFakeTimers()
+		})
+
+		afterEach(() => {
+			vi.useRealTimers()
+		})
+
+		it("should refresh the token ahead of expiry while the credentials are in use", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() + 10 * 60 * 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			const handler = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() })
+			await handler.completePrompt("first")
+			await handler.completePrompt("second")
+			expect(global.fetch).not.toHaveBeenCalled()
+
+			await vi.advanceTimersByTimeAsync(5 * 60 * 1000)
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+			expect(JSON.parse(mockWriteFile.mock.calls[0][1]).access_token).toBe("new-access-token")
+		})
+
+		it("should not count the use that scheduled the timer as activity", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() + 10 * 60 * 1000 })))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+			await vi.advanceTimersByTimeAsync(5 * 60 * 1000)
+
+			expect(global.fetch).not.toHaveBeenCalled()
+		})
+
+		it("should not count a use that refreshed inline as activity", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+			vi.mocked(global.fetch).mockImplementation(async () => tokenResponse())
+
+			await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+
+			await vi.advanceTimersByTimeAsync(60 * 60 * 1000)
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+
+		it("should share one timer and one refresh between handlers using the same file", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() + 10 * 60 * 1000 })))
+			vi.mocked(global.fetch).mockImplementation(async () => tokenResponse())
+
+			const handlers = [1, 2, 3].map(() => new QwenCodeHandler({ qwenCodeOauthPath }))
+			for (const handler of handlers) {
+				await handler.completePrompt("test")
+			}
+
+			await vi.advanceTimersByTimeAsync(5 * 60 * 1000)
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+
+		it("should skip the refresh when the file already holds a fresh token", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockReadFile.mockResolvedValueOnce(
+				JSON.stringify(makeCredentials({ expiry_date: Date.now() + 10 * 60 * 1000 })),
+			)
+
+			const handler = new QwenCodeHandler({ qwenCodeOauthPath })
+			await handler.completePrompt("first")
+			await handler.completePrompt("second")
+
+			// Another window refreshed and rewrote the file before our timer fired
+			mockStat.mockResolvedValue({ mtimeMs: 2 })
+			mockReadFile.mockResolvedValue(
+				JSON.stringify(
+					makeCredentials({ access_token: "other-window-token", expiry_date: Date.now() + 60 * 60 * 1000 }),
+				),
+			)
+
+			await vi.advanceTimersByTimeAsync(5 * 60 * 1000)
+
+			expect(global.fetch).not.toHaveBeenCalled()
+			expect(mockWriteFile).not.toHaveBeenCalled()
+		})
+
+		it("should stop refreshing once the credentials go idle", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials({ expiry_date: Date.now() + 10 * 60 * 1000 })))
+			vi.mocked(global.fetch).mockImplementation(async () => tokenResponse(600))
+
+			const handler = new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() })
+			await handler.completePrompt("first")
+			await handler.completePrompt("second")
+
+			await vi.advanceTimersByTimeAsync(60 * 60 * 1000)
+
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+		})
+	})
+
+	describe("inline refresh", () => {
+		it("should reuse a token another process already refreshed instead of refreshing again", async () => {
+			const qwenCodeOauthPath = uniqueOauthPath()
+			mockStat.mockResolvedValueOnce({ mtimeMs: 1 }).mockResolvedValue({ mtimeMs: 2 })
+			mockReadFile
+				.mockResolvedValueOnce(JSON.stringify(makeCredentials({ expiry_date: Date.now() - 1000 })))
+				.mockResolvedValue(
+					JSON.stringify(
+						makeCredentials({ access_token: "other-window-token", expiry_date: Date.now() + 60 * 60 * 1000 }),
+					),
+				)
+
+			await new QwenCodeHandler({ qwenCodeOauthPath }).completePrompt("test")
+
+			expect(global.fetch).not.toHaveBeenCalled()
+			const client = vi.mocked(OpenAI).mock.results.at(-1)!.value
+			expect(client.apiKey).toBe("other-window-token")
+		})
+
+		it("should refresh again after a 401 even if the token has not expired", async () => {
+			mockReadFile.mockResolvedValue(JSON.stringify(makeCredentials()))
+			vi.mocked(global.fetch).mockResolvedValue(tokenResponse())
+			mockCreate
+				.mockRejectedValueOnce(Object.assign(new Error("Unauthorized"), { status: 401 }))
+				.mockResolvedValue({ choices: [{ message: { content: "Test response" } }] })
+
+			const result = await new QwenCodeHandler({ qwenCodeOauthPath: uniqueOauthPath() }).completePrompt("test")
+
+			expect(result).toBe("Test response")
+			expect(global.fetch).toHaveBeenCalledTimes(1)
+			const client = vi.mocked(OpenAI).mock.results.at(-1)!.value
+			expect(client.apiKey).toBe("new-access-token")
+		})
+	})
+})
@@ -3,6 +3,7 @@ import { Anthropic } from "@anthropic-ai/sdk"
 import OpenAI from "openai"
 import * as os from "os"
 import * as path from "path"
+import * as lockfile from "proper-lockfile"
 
 import { type ModelInfo, type QwenCodeModelId, qwenCodeModels, qwenCodeDefaultModelId } from "@roo-code/types"
 
@@ -17,8 +18,24 @@ import type { SingleCompletionHandler } from "../index"
 const QWEN_OAUTH_BASE_URL = "https://chat.qwen.ai"
 const QWEN_OAUTH_TOKEN_ENDPOINT = `${QWEN_OAUTH_BASE_URL}/api/v1/oauth2/token`
 const QWEN_OAUTH_CLIENT_ID = "f0304373b74a44d2b584a3fb70ca9e56"
+const QWEN_OAUTH_TOKEN_HEADERS = {
+	"Content-Type": "application/x-www-form-urlencoded",
+	Accept: "application/json",
+}
+const QWEN_DEFAULT_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 const QWEN_DIR = ".qwen"
 const QWEN_CREDENTIAL_FILENAME = "oauth_creds.json"
+const TOKEN_REFRESH_MAX_RETRIES = 3
+const TOKEN_REFRESH_BACKOFF_MS = 200
+const TOKEN_REFRESH_RETRYABLE_STATUSES = new Set([429, 500, 502, 503, 504])
+const TOKEN_REFRESH_MAX_RETRY_AFTER_MS = 10 * 1000
+// Refresh 5 minutes early to absorb network latency and clock skew
+const TOKEN_REFRESH_BUFFER_MS = 5 * 60 * 1000
+const SLOW_TOKEN_REFRESH_RTT_MS = 1000
+const TOKEN_BACKGROUND_REFRESH_LEAD_MS = TOKEN_REFRESH_BUFFER_MS + 60 * 1000
+const TOKEN_BACKGROUND_REFRESH_JITTER_MS = 30 * 1000
+const MIN_BACKGROUND_REFRESH_DELAY_MS = 1000
+const MAX_TIMER_DELAY_MS = 2 ** 31 - 1
 
 interface QwenOAuthCredentials {
 	access_token: string
@@ -32,6 +49,10 @@ interface QwenCodeHandlerOptions extends ApiHandlerOptions {
 	qwenCodeOauthPath?: string
 }
 
+// Parsed credentials shared across handler instances, keyed by file path and
+// invalidated whenever the file's mtime changes (e.g. after a re-login).
+const credentialCache = new Map<string, { mtimeMs: number; credentials: QwenOAuthCredentials }>()
+
 function getQwenCachedCredentialPath(customPath?: string): string {
 	if (customPath) {
 		// Support custom path that starts with ~/ or is absolute
@@ -43,145 +64,383 @@ function getQwenCachedCredentialPath(customPath?: string): string {
 	return path.join(os.homedir(), QWEN_DIR, QWEN_CREDENTIAL_FILENAME)
 }
 
+function normalizeQwenBaseUrl(rawUrl: string): string {
+	let baseUrl = rawUrl
+	if (!baseUrl.startsWith("http://") && !baseUrl.startsWith("https://")) {
+		baseUrl = `https://${baseUrl}`
+	}
+	return baseUrl.endsWith("/v1") ? baseUrl : `${baseUrl}/v1`
+}
+
+function delay(ms: number): Promise<void> {
+	return new Promise((resolve) => setTimeout(resolve, ms))
+}
+
+// Retry-After is either a number of seconds or an HTTP date
+function parseRetryAfterMs(retryAfter: string | null): number | undefined {
+	if (!retryAfter) {
+		return undefined
+	}
+	const seconds = Number(retryAfter)
+	if (Number.isFinite(seconds)) {
+		return Math.max(0, seconds * 1000)
+	}
+	const date = Date.parse(retryAfter)
+	return Number.isNaN(date) ? undefined : Math.max(0, date - Date.now())
+}
+
 function objectToUrlEncoded(data: Record<string, string>): string {
 	return Object.keys(data)
 		.map((key) => `${encodeURIComponent(key)}=${encodeURIComponent(data[key])}`)
 		.join("&")
 }
 
-export class QwenCodeHandler extends BaseProvider implements SingleCompletionHandler {
-	protected options: QwenCodeHandlerOptions
-	private credentials: QwenOAuthCredentials | null = null
-	private client: OpenAI | undefined
-	private refreshPromise: Promise<QwenOAuthCredentials> | null = null
+// Only one refresh per credential file is in flight at a time, shared by every handler
+const refreshPromises = new Map<string, Promise<QwenOAuthCredentials>>()
+// One background refresh timer per credential file, however many handlers use it
+const refreshTimers = new Map<string, ReturnType<typeof setTimeout>>()
+const pathsUsedSinceRefreshScheduled = new Set<string>()
+// Round-trip time of the most recent single token endpoint request
+let lastRefreshRttMs = 0
+
+async function loadQwenCredentials(filePath: string): Promise<QwenOAuthCredentials> {
+	try {
+		const { mtimeMs } = await fs.stat(filePath)
+		const cached = credentialCache.get(filePath)
+		if (cached && cached.mtimeMs === mtimeMs) {
+			return { ...cached.credentials }
+		}
 
-	constructor(options: QwenCodeHandlerOptions) {
-		super()
-		this.options = options
+		const credsStr = await fs.readFile(filePath, "utf-8")
+		const credentials: QwenOAuthCredentials = JSON.parse(credsStr)
+		credentialCache.set(filePath, { mtimeMs, credentials })
+		return { ...credentials }
+	} catch (error) {
+		console.error(`Error reading or parsing credentials file at ${filePath}`)
+		throw new Error(`Failed to load Qwen OAuth credentials: ${error}`)
 	}
+}
 
-	private ensureClient(): OpenAI {
-		if (!this.client) {
-			// Create the client instance with dummy key initially
-			// The API key will be updated dynamically via ensureAuthenticated
-			this.client = new OpenAI({
-				apiKey: "dummy-key-will-be-replaced",
-				baseURL: "https://dashscope.aliyuncs.com/compatible-mode/v1",
-			})
-		}
-		return this.client
+function isTokenValid(credentials: QwenOAuthCredentials): boolean {
+	if (!credentials.expiry_date) {
+		return false
 	}
+	return Date.now() < credentials.expiry_date - TOKEN_REFRESH_BUFFER_MS - getSlowRefreshAllowanceMs()
+}
 
-	private async loadCachedQwenCredentials(): Promise<QwenOAuthCredentials> {
-		try {
-			const keyFile = getQwenCachedCredentialPath(this.options.qwenCodeOauthPath)
-			const credsStr = await fs.readFile(keyFile, "utf-8")
-			return JSON.parse(credsStr)
-		} catch (error) {
-			console.error(
-				`Error reading or parsing credentials file at ${getQwenCachedCredentialPath(this.options.qwenCodeOauthPath)}`,
-			)
-			throw new Error(`Failed to load Qwen OAuth credentials: ${error}`)
-		}
+// A slow token endpoint means the next refresh will be slow too, so start it earlier
+function getSlowRefreshAllowanceMs(): number {
+	return lastRefreshRttMs > SLOW_TOKEN_REFRESH_RTT_MS ? lastRefreshRttMs : 0
+}
+
+async function refreshQwenCredentials(
+	filePath: string,
+	credentials: QwenOAuthCredentials,
+): Promise<QwenOAuthCredentials> {
+	// If a refresh is already in progress, return the existing promise
+	const inFlight = refreshPromises.get(filePath)
+	if (inFlight) {
+		return inFlight
 	}
 
-	private async refreshAccessToken(credentials: QwenOAuthCredentials): Promise<QwenOAuthCredentials> {
-		// If a refresh is already in progress, return the existing promise
-		if (this.refreshPromise) {
-			return this.refreshPromise
+	const refreshPromise = refreshLatestQwenCredentials(filePath, credentials)
+	refreshPromises.set(filePath, refreshPromise)
+
+	try {
+		return await refreshPromise
+	} finally {
+		// Clear the promise after completion (success or failure)
+		refreshPromises.delete(filePath)
+	}
+}
+
+async function refreshLatestQwenCredentials(
+	filePath: string,
+	credentials: QwenOAuthCredentials,
+): Promise<QwenOAuthCredentials> {
+	// Another handler, VS Code window or the qwen CLI may have refreshed already.
+	// Reusing their token avoids spending a refresh_token the server has rotated.
+	let latest = credentials
+	try {
+		latest = await loadQwenCredentials(filePath)
+	} catch {
+		// Fall back to the in-memory credentials if the file can't be read
+	}
+
+	if (latest.access_token !== credentials.access_token && isTokenValid(latest)) {
+		return latest
+	}
+
+	let refreshed: QwenOAuthCredentials
+	try {
+		refreshed = await doRefreshQwenCredentials(filePath, latest)
+	} catch (error) {
+		// The cache may hold credentials another process has since replaced (e.g. a
+		// write that landed between our save and its stat), so re-read the file next time
+		credentialCache.delete(filePath)
+		throw error
+	}
+
+	scheduleBackgroundRefresh(filePath, refreshed)
+	return refreshed
+}
+
+async function doRefreshQwenCredentials(
+	filePath: string,
+	credentials: QwenOAuthCredentials,
+): Promise<QwenOAuthCredentials> {
+	if (!credentials.refresh_token) {
+		throw new Error("No refresh token available in credentials.")
+	}
+
+	const bodyData = {
+		grant_type: "refresh_token",
+		refresh_token: credentials.refresh_token,
+		client_id: QWEN_OAUTH_CLIENT_ID,
+	}
+
+	const response = await fetchTokenWithRetry(objectToUrlEncoded(bodyData))
+
+	if (!response.ok) {
+		const errorText = await response.text()
+		throw new Error(`Token refresh failed: ${response.status} ${response.statusText}. Response: ${errorText}`)
+	}
+
+	const tokenData = await response.json()
+
+	if (tokenData.error) {
+		throw new Error(`Token refresh failed: ${tokenData.error} - ${tokenData.error_description}`)
+	}
+
+	// Update in place: credentials is a private copy from loadQwenCredentials, or the
+	// caller's own object when the file couldn't be read
+	credentials.access_token = tokenData.access_token
+	credentials.token_type = tokenData.token_type
+	credentials.refresh_token = tokenData.refresh_token || credentials.refresh_token
+	credentials.expiry_date = Date.now() + tokenData.expires_in * 1000
+
+	try {
+		await saveQwenCredentials(filePath, credentials)
+	} catch (error) {
+		console.error("Failed to save refreshed credentials:", error)
+		// Continue with the refreshed token in memory even if file write fails
+	}
+
+	return credentials
+}
+
+async function saveQwenCredentials(filePath: string, credentials: QwenOAuthCredentials): Promise<void> {
+	// Lock against other extension hosts refreshing at the same time
+	const releaseLock = await lockfile.lock(filePath, {
+		stale: 31000,
+		update: 10000,
+		realpath: false, // the file may not exist yet
+		retries: { retries: 5, factor: 2, minTimeout: 100, maxTimeout: 1000 },
+		onCompromised: (error) => console.error(`Lock at ${filePath} was compromised:`, error),
+	})
+
+	// Rename a uniquely named temp file straight over the target. The rename is
+	// atomic, so readers (and a crash at any point) see either the old file or
+	// the new one, never a missing or truncated one.
+	const tempPath = path.join(
+		path.dirname(filePath),
+		`.${path.basename(filePath)}.new_${Date.now()}_${Math.random().toString(36).substring(2)}.tmp`,
+	)
+
+	try {
+		await fs.writeFile(tempPath, JSON.stringify(credentials, null, 2), { mode: 0o600 })
+
+		// rename keeps the temp file's mtime, so stat it now rather than the target
+		// afterwards, when another process may already have replaced it
+		let mtimeMs: number | undefined
+		try {
+			mtimeMs = (await fs.stat(tempPath)).mtimeMs
+		} catch {
+			// Leave the next load to read the file instead of seeding the cache
 		}
 
-		// Create a new refresh promise
-		this.refreshPromise = this.doRefreshAccessToken(credentials)
+		await fs.rename(tempPath, filePath)
 
+		// Seed the cache so other handlers don't re-read the file we just wrote
+		if (mtimeMs !== undefined) {
+			credentialCache.set(filePath, { mtimeMs, credentials: { ...credentials } })
+		} else {
+			credentialCache.delete(filePath)
+		}
+	} catch (error) {
+		await fs.unlink(tempPath).catch(() => {})
+		throw error
+	} finally {
 		try {
-			const result = await this.refreshPromise
-			return result
-		} finally {
-			// Clear the promise after completion (success or failure)
-			this.refreshPromise = null
+			await releaseLock()
+		} catch (error) {
+			console.error(`Failed to release lock for ${filePath}:`, error)
 		}
 	}
+}
 
-	private async doRefreshAccessToken(credentials: QwenOAuthCredentials): Promise<QwenOAuthCredentials> {
-		if (!credentials.refresh_token) {
-			throw new Error("No refresh token available in credentials.")
+async function fetchTokenWithRetry(body: string): Promise<Response> {
+	// Token refreshes gate every request, so ride out brief network blips and
+	// transient server errors instead of failing the whole request.
+	for (let attempt = 0; ; attempt++) {
+		let response: Response
+		try {
+			// Use the monotonic clock so wall-clock adjustments can't skew the measured latency
+			const attemptStartedAt = performance.now()
+			response = await fetch(QWEN_OAUTH_TOKEN_ENDPOINT, {
+				method: "POST",
+				headers: QWEN_OAUTH_TOKEN_HEADERS,
+				body,
+			})
+			// Time a single attempt only, so retry backoff doesn't count as latency
+			lastRefreshRttMs = Math.round(performance.now() - attemptStartedAt)
+		} catch (error) {
+			// fetch rejects on network-level failures (connection reset, DNS, TLS)
+			if (attempt >= TOKEN_REFRESH_MAX_RETRIES) {
+				throw error
+			}
+			await delay(TOKEN_REFRESH_BACKOFF_MS * 2 ** attempt)
+			continue
 		}
 
-		const bodyData = {
-			grant_type: "refresh_token",
-			refresh_token: credentials.refresh_token,
-			client_id: QWEN_OAUTH_CLIENT_ID,
+		if (!TOKEN_REFRESH_RETRYABLE_STATUSES.has(response.status) || attempt >= TOKEN_REFRESH_MAX_RETRIES) {
+			return response
 		}
 
-		const response = await fetch(QWEN_OAUTH_TOKEN_ENDPOINT, {
-			method: "POST",
-			headers: {
-				"Content-Type": "application/x-www-form-urlencoded",
-				Accept: "application/json",
-			},
-			body: objectToUrlEncoded(bodyData),
-		})
-
-		if (!response.ok) {
-			const errorText = await response.text()
-			throw new Error(`Token refresh failed: ${response.status} ${response.statusText}. Response: ${errorText}`)
+		const retryAfterMs = parseRetryAfterMs(response.headers.get("retry-after"))
+		if (retryAfterMs !== undefined && retryAfterMs > TOKEN_REFRESH_MAX_RETRY_AFTER_MS) {
+			// Don't stall the request for a long server-requested cooldown
+			return response
 		}
 
-		const tokenData = await response.json()
+		// Discard the unread body so the pooled connection is released before we retry
+		await response.body?.cancel()
+		await delay(retryAfterMs ?? TOKEN_REFRESH_BACKOFF_MS * 2 ** attempt)
+	}
+}
 
-		if (tokenData.error) {
-			throw new Error(`Token refresh failed: ${tokenData.error} - ${tokenData.error_description}`)
-		}
+/**
+ * Refreshes the access token shortly before it expires so that requests don't
+ * pay the refresh round-trip inline. The timer only re-arms if the credentials
+ * were used after it was scheduled; idle paths fall back to refreshing inline.
+ */
+function scheduleBackgroundRefresh(filePath: string, credentials: QwenOAuthCredentials): void {
+	clearTimeout(refreshTimers.get(filePath))
+	pathsUsedSinceRefreshScheduled.delete(filePath)
+
+	// Jitter spreads out refreshes from VS Code windows sharing the same file
+	const timeoutMs = Math.min(
+		Math.max(
+			MIN_BACKGROUND_REFRESH_DELAY_MS,
+			credentials.expiry_date -
+				TOKEN_BACKGROUND_REFRESH_LEAD_MS -
+				getSlowRefreshAllowanceMs() -
+				Date.now() +
+				Math.random() * TOKEN_BACKGROUND_REFRESH_JITTER_MS,
+		),
+		MAX_TIMER_DELAY_MS,
+	)
+
+	const timer = setTimeout(() => void backgroundRefresh(filePath), timeoutMs)
+	// Don't keep the extension host alive just to refresh a token.
+	timer.unref?.()
+	refreshTimers.set(filePath, timer)
+}
 
-		const newCredentials = {
-			...credentials,
-			access_token: tokenData.access_token,
-			token_type: tokenData.token_type,
-			refresh_token: tokenData.refresh_token || credentials.refresh_token,
-			expiry_date: Date.now() + tokenData.expires_in * 1000,
-		}
+function markQwenCredentialsUsed(filePath: string, credentials: QwenOAuthCredentials): void {
+	if (refreshTimers.has(filePath)) {
+		pathsUsedSinceRefreshScheduled.add(filePath)
+	} else {
+		scheduleBackgroundRefresh(filePath, credentials)
+	}
+}
 
-		const filePath = getQwenCachedCredentialPath(this.options.qwenCodeOauthPath)
-		try {
-			await fs.writeFile(filePath, JSON.stringify(newCredentials, null, 2))
-		} catch (error) {
-			console.error("Failed to save refreshed credentials:", error)
-			// Continue with the refreshed token in memory even if file write fails
+async function backgroundRefresh(filePath: string): Promise<void> {
+	refreshTimers.delete(filePath)
+
+	if (!pathsUsedSinceRefreshScheduled.delete(filePath)) {
+		return
+	}
+
+	try {
+		const credentials = await loadQwenCredentials(filePath)
+		if (credentials.expiry_date - TOKEN_BACKGROUND_REFRESH_LEAD_MS > Date.now()) {
+			// Someone else already refreshed; just wait for the new expiry
+			scheduleBackgroundRefresh(filePath, credentials)
+			return
 		}
+		await refreshQwenCredentials(filePath, credentials)
+	} catch (error) {
+		console.error("Background Qwen OAuth token refresh failed:", error)
+	}
+}
 
-		return newCredentials
+export class QwenCodeHandler extends BaseProvider implements SingleCompletionHandler {
+	protected options: QwenCodeHandlerOptions
+	private credentials: QwenOAuthCredentials | null = null
+	private client: OpenAI | undefined
+	private loadPromise: Promise<QwenOAuthCredentials> | null = null
+
+	constructor(options: QwenCodeHandlerOptions) {
+		super()
+		this.options = options
 	}
 
-	private isTokenValid(credentials: QwenOAuthCredentials): boolean {
-		const TOKEN_REFRESH_BUFFER_MS = 30 * 1000 // 30s buffer
-		if (!credentials.expiry_date) {
-			return false
+	private ensureClient(): OpenAI {
+		if (!this.client) {
+			// Create the client instance with dummy key initially
+			// The API key will be updated dynamically via ensureAuthenticated
+			this.client = new OpenAI({
+				apiKey: "dummy-key-will-be-replaced",
+				baseURL: QWEN_DEFAULT_BASE_URL,
+			})
 		}
-		return Date.now() < credentials.expiry_date - TOKEN_REFRESH_BUFFER_MS
+		return this.client
+	}
+
+	private get credentialPath(): string {
+		return getQwenCachedCredentialPath(this.options.qwenCodeOauthPath)
+	}
+
+	private async loadCachedQwenCredentials(): Promise<QwenOAuthCredentials> {
+		return loadQwenCredentials(this.credentialPath)
+	}
+
+	private async refreshAccessToken(credentials: QwenOAuthCredentials): Promise<QwenOAuthCredentials> {
+		return refreshQwenCredentials(this.credentialPath, credentials)
 	}
 
 	private async ensureAuthenticated(): Promise<void> {
 		if (!this.credentials) {
-			this.credentials = await this.loadCachedQwenCredentials()
+			// Concurrent requests on a fresh handler share a single credential load
+			if (!this.loadPromise) {
+				this.loadPromise = this.loadCachedQwenCredentials().finally(() => {
+					this.loadPromise = null
+				})
+			}
+			this.credentials = await this.loadPromise
 		}
 
-		if (!this.isTokenValid(this.credentials)) {
+		if (!isTokenValid(this.credentials)) {
+			// The refresh (re)schedules the timer itself, and the request that triggered
+			// it shouldn't count as activity that keeps the background refresh going
 			this.credentials = await this.refreshAccessToken(this.credentials)
+		} else {
+			markQwenCredentialsUsed(this.credentialPath, this.credentials)
 		}
 
 		// After authentication, update the apiKey and baseURL on the existing client
+		this.applyCredentialsToClient(this.credentials)
+	}
+
+	private applyCredentialsToClient(credentials: QwenOAuthCredentials): void {
 		const client = this.ensureClient()
-		client.apiKey = this.credentials.access_token
-		client.baseURL = this.getBaseUrl(this.credentials)
+		client.apiKey = credentials.access_token
+		client.baseURL = this.getBaseUrl(credentials)
 	}
 
 	private getBaseUrl(creds: QwenOAuthCredentials): string {
-		let baseUrl = creds.resource_url || "https://dashscope.aliyuncs.com/compatible-mode/v1"
-		if (!baseUrl.startsWith("http://") && !baseUrl.startsWith("https://")) {
-			baseUrl = `https://${baseUrl}`
-		}
-		return baseUrl.endsWith("/v1") ? baseUrl : `${baseUrl}/v1`
+		return normalizeQwenBaseUrl(creds.resource_url || QWEN_DEFAULT_BASE_URL)
 	}
 
 	private async callApiWithRetry<T>(apiCall: () => Promise<T>): Promise<T> {
@@ -191,9 +450,7 @@ export class QwenCodeHandler extends BaseProvider implements SingleCompletionHan
 			if (error.status === 401) {
 				// Token expired, refresh and retry
 				this.credentials = await this.refreshAccessToken(this.credentials!)
-				const client = this.ensureClient()
-				client.apiKey = this.credentials.access_token
-				client.baseURL = this.getBaseUrl(this.credentials)
+				this.applyCredentialsToClient(this.credentials)
 				return await apiCall()
 			} else {
 				throw error